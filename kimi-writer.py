@@ -9,21 +9,37 @@ and short story collections based on user prompts.
 import os
 import sys
 import json
+import time
+from datetime import datetime
+import asyncio
 import argparse
+import signal
+import httpx
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-from openai import OpenAI
-from typing import List, Dict, Any
+from openai import AsyncOpenAI
+from typing import List, Dict, Any, Union
 
 # Load environment variables from .env file
 load_dotenv()
 
 from utils import (
-    estimate_token_count, 
+    HTTP_LIMITS,
+    HTTP_TIMEOUT,
+    cached_estimate_token_count,
+    fast_estimate_raw,
+    count_tokens,
+    count_message_tokens,
+    short_json,
+    strip_stale_reasoning,
+    postprocess_tool_result,
     get_tool_definitions, 
     get_tool_map,
     get_system_prompt
 )
-from tools.compression import compress_context_impl
+from tools.compression import compress_context_async, snapshot_messages, load_snapshot
+from tools.project import get_active_project_folder, set_active_project_folder
 
 
 # Constants
@@ -31,22 +47,33 @@ MAX_ITERATIONS = 300
 TOKEN_LIMIT = 200000
 COMPRESSION_THRESHOLD = 180000  # Trigger compression at 90% of limit
 MODEL_NAME = "kimi-k2-thinking"
-BACKUP_INTERVAL = 50  # Save backup summary every N iterations
-
-
-def load_context_from_file(file_path: str) -> str:
+BACKUP_INTERVAL = 50  # Save backup snapshot every N iterations
+ESTIMATE_MARGIN = 0.85  # Always ask the API for a real count above 85% of threshold
+DRIFT_CHECK_INTERVAL = 10  # Otherwise re-check the running count every N iterations
+MAX_WORKERS = 8  # Background threads for parallel tool calls
+PARALLEL_TOOLS = {"write_file"}  # Tools that may run concurrently with each other
+RECENT_RESULTS_WINDOW = 8  # Repeated tool results within this window are folded
+STDOUT_FLUSH_INTERVAL = 0.05  # Seconds between stdout flushes while streaming
+PROGRESS_INTERVAL = 0.1  # Seconds between tool argument progress updates
+EXIT_SAVE_TIMEOUT = 10  # Seconds to wait for the exit summary before falling back to a snapshot
+
+
+def load_context_from_file(file_path: str) -> Union[str, Dict[str, Any]]:
     """
-    Loads context from a summary file for recovery.
+    Loads context from a summary or snapshot file for recovery.
     
     Args:
-        file_path: Path to the context summary file
+        file_path: Path to the context summary (.md) or snapshot (.json.zst) file
         
     Returns:
-        Content of the file as string
+        Content of a summary file as string, or the loaded snapshot dictionary
     """
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
+        if file_path.endswith('.json.zst'):
+            content = load_snapshot(file_path)
+        else:
+            with open(file_path, 'r', encoding='utf-8') as f:
+                content = f.read()
         print(f"✓ Loaded context from: {file_path}\n")
         return content
     except Exception as e:
@@ -54,7 +81,7 @@ def load_context_from_file(file_path: str) -> str:
         sys.exit(1)
 
 
-def get_user_input() -> tuple[str, bool]:
+def get_user_input() -> tuple[Union[str, Dict[str, Any]], bool]:
     """
     Gets user input from command line, either as a prompt or recovery file.
     
@@ -71,6 +98,9 @@ Examples:
   
   # Recovery mode from previous context
   python kimi-writer.py --recover my_project/.context_summary_20250107_143022.md
+  
+  # Recovery mode from a full snapshot
+  python kimi-writer.py --recover my_project/.context_snapshot_20250107_143022.json.zst
         """
     )
     
@@ -82,7 +112,7 @@ Examples:
     parser.add_argument(
         '--recover',
         type=str,
-        help='Path to a context summary file to continue from'
+        help='Path to a context summary or snapshot file to continue from'
     )
     
     args = parser.parse_args()
@@ -132,60 +162,184 @@ Examples:
     return prompt, False
 
 
-def convert_message_for_api(msg: Any) -> Dict[str, Any]:
+class ToolCallSlot:
+    """
+    Accumulates one streamed tool call.
+    
+    Uses __slots__ since a slot is touched on every tool-call chunk.
     """
-    Converts a message object to a dictionary suitable for API calls.
-    Preserves reasoning_content if present.
+    
+    __slots__ = ("id", "name", "arguments_parts", "chars_received", "tokens_estimate")
+    
+    def __init__(self):
+        self.id = None
+        self.name = ""
+        self.arguments_parts = []
+        self.chars_received = 0
+        self.tokens_estimate = 0.0  # Unrounded, so small fragments add up correctly
+    
+    def progress_line(self) -> str:
+        """Returns the argument progress indicator for this call."""
+        return f"\r💬 Generating arguments... {self.chars_received:,} characters (~{int(self.tokens_estimate + 0.5):,} tokens)"
+
+
+def parse_tool_arguments(args_str: str) -> Dict[str, Any]:
+    """
+    Parses the JSON arguments of a tool call.
     
     Args:
-        msg: Message object (can be OpenAI message object or dict)
+        args_str: The raw arguments string from the model
         
     Returns:
-        Dictionary representation of the message
+        Parsed arguments, or an empty dict if they are not a valid JSON object
+    """
+    try:
+        args = json.loads(args_str)
+    except json.JSONDecodeError:
+        return {}
+    return args if isinstance(args, dict) else {}
+
+
+def run_tool(tool_map: Dict[str, Any], func_name: str, args: Dict[str, Any]) -> tuple[str, bool]:
+    """
+    Runs a regular tool and captures any failure as a result string.
+    
+    Args:
+        tool_map: Mapping of tool names to implementations
+        func_name: Name of the tool to call
+        args: Parsed arguments for the tool
+        
+    Returns:
+        Tuple of (result, success)
+    """
+    tool_func = tool_map.get(func_name)
+    if not tool_func:
+        return f"Error: Unknown tool '{func_name}'", False
+    
+    try:
+        result = tool_func(**args)
+    except Exception as tool_error:
+        # Catch any exception during tool execution
+        return f"Error executing tool '{func_name}': {str(tool_error)}", False
+    
+    if result is None:
+        return f"Error: Tool '{func_name}' returned no result", False
+    return str(result), True
+
+
+def batch_tool_calls(tool_calls: List[Dict], parsed_args: List[Dict]) -> List[List[int]]:
+    """
+    Groups tool calls into consecutive batches that are safe to run concurrently.
+    
+    Only PARALLEL_TOOLS are batched together; anything else (create_project,
+    compress_context, unknown tools) runs alone so ordering is preserved.
+    Writes to the same file always land in separate batches.
+    
+    Args:
+        tool_calls: Tool calls from the assistant message, in order
+        parsed_args: Parsed arguments for each tool call
+        
+    Returns:
+        List of batches, each a list of indexes into tool_calls
+    """
+    batches = []
+    current = []
+    current_files = set()
+    
+    for i, tool_call in enumerate(tool_calls):
+        func_name = tool_call["function"]["name"]
+        if func_name not in PARALLEL_TOOLS:
+            if current:
+                batches.append(current)
+            batches.append([i])
+            current, current_files = [], set()
+            continue
+        
+        filename = str(parsed_args[i].get("filename", ""))
+        if not filename.endswith('.md'):
+            filename += '.md'
+        # Names that may point at the same file (./ch1.md, Ch1.md on a
+        # case-insensitive filesystem) must not run concurrently either
+        file_key = os.path.normcase(os.path.normpath(filename)).lower()
+        if file_key in current_files:
+            batches.append(current)
+            current, current_files = [], set()
+        current.append(i)
+        current_files.add(file_key)
+    
+    if current:
+        batches.append(current)
+    return batches
+
+
+async def save_context_on_exit(
+    messages: List[Dict],
+    client: AsyncOpenAI,
+    reasoning_log: List[tuple[int, str]],
+    tool_results_full: Dict[str, str]
+) -> None:
     """
-    if isinstance(msg, dict):
-        return msg
-    
-    # Convert OpenAI message object to dict
-    msg_dict = {
-        "role": msg.role,
-    }
-    
-    if msg.content:
-        msg_dict["content"] = msg.content
-    
-    # Preserve reasoning_content if present
-    if hasattr(msg, "reasoning_content"):
-        reasoning = getattr(msg, "reasoning_content")
-        if reasoning:
-            msg_dict["reasoning_content"] = reasoning
-    
-    # Preserve tool calls if present
-    if hasattr(msg, "tool_calls") and msg.tool_calls:
-        msg_dict["tool_calls"] = [
-            {
-                "id": tc.id,
-                "type": "function",
-                "function": {
-                    "name": tc.function.name,
-                    "arguments": tc.function.arguments
-                }
-            }
-            for tc in msg.tool_calls
-        ]
-    
-    # Preserve tool call id for tool response messages
-    if hasattr(msg, "tool_call_id") and msg.tool_call_id:
-        msg_dict["tool_call_id"] = msg.tool_call_id
-    
-    if hasattr(msg, "name") and msg.name:
-        msg_dict["name"] = msg.name
-    
-    return msg_dict
+    Saves the context for recovery when the agent stops early.
+    
+    The summary call is bounded by EXIT_SAVE_TIMEOUT so quitting never hangs
+    on the API. If it times out or fails, the full history is written to a
+    local emergency snapshot instead.
+    
+    Args:
+        messages: The full message history
+        client: The AsyncOpenAI client instance
+        reasoning_log: Raw reasoning per iteration
+        tool_results_full: Original text of shortened tool results
+    """
+    saved_file = None
+    try:
+        compression_result = await asyncio.wait_for(
+            compress_context_async(
+                messages=messages,
+                client=client,
+                model=MODEL_NAME,
+                keep_recent=0  # Summarize everything, this is only saved to disk
+            ),
+            timeout=EXIT_SAVE_TIMEOUT
+        )
+        if compression_result.get("summary_file") and not compression_result["summary_file"].startswith("Error"):
+            saved_file = compression_result["summary_file"]
+        else:
+            print(f"⚠️  {compression_result.get('message', 'No summary was saved.')}")
+    except asyncio.TimeoutError:
+        print(f"⚠️  Summary took longer than {EXIT_SAVE_TIMEOUT}s.")
+    except Exception as e:
+        print(f"⚠️  Could not save summary: {e}")
+    
+    if not saved_file:
+        print("Saving a local snapshot instead...")
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        filename = f".emergency_{timestamp}.json.zst"
+        project_folder = get_active_project_folder()
+        try:
+            saved_file = snapshot_messages(
+                messages,
+                reasoning_log,
+                tool_results_full,
+                path=os.path.join(project_folder, filename) if project_folder else filename
+            )
+        except Exception as e:
+            print(f"✗ Error saving context: {e}")
+            return
+    
+    print(f"✓ Context saved to: {saved_file}")
+    print(f"\nTo resume, run:")
+    print(f"  python kimi-writer.py --recover {saved_file}")
 
 
-def main():
-    """Main agent loop."""
+async def main(user_prompt: Union[str, Dict[str, Any]], is_recovery: bool):
+    """
+    Main agent loop.
+    
+    Args:
+        user_prompt: The writing request, or the recovered context
+        is_recovery: Whether user_prompt was loaded from a recovery file
+    """
     
     # Get API key
     api_key = os.getenv("MOONSHOT_API_KEY")
@@ -196,6 +350,16 @@ def main():
     
     base_url = os.getenv("MOONSHOT_BASE_URL", "https://api.moonshot.ai/v1")
     
+    # Count tokens locally unless the Moonshot estimate endpoint is requested
+    remote_tokens = bool(os.getenv("KIMI_REMOTE_TOKENS"))
+    
+    # Reasoning of finished turns (before the last user message) is dropped
+    # from the history unless explicitly requested
+    keep_reasoning = bool(os.getenv("KEEP_REASONING"))
+    
+    # Print full tool arguments instead of a truncated preview
+    debug = bool(os.getenv("KIMI_DEBUG"))
+    
     # Debug: Show that key is loaded (masked for security)
     if len(api_key) > 8:
         print(f"✓ API Key loaded: {api_key[:4]}...{api_key[-4:]}")
@@ -203,21 +367,56 @@ def main():
         print(f"⚠️  Warning: API key seems too short ({len(api_key)} chars)")
     print(f"✓ Base URL: {base_url}\n")
     
-    # Initialize OpenAI client
-    client = OpenAI(
+    # Initialize OpenAI client on a pooled HTTP/2 connection, shared by the
+    # chat loop and every compression call
+    client = AsyncOpenAI(
         api_key=api_key,
         base_url=base_url,
+        http_client=httpx.AsyncClient(
+            http2=True,
+            limits=HTTP_LIMITS,
+            timeout=HTTP_TIMEOUT
+        ),
     )
     
-    # Get user input
-    user_prompt, is_recovery = get_user_input()
+    # Threads used for blocking work (tools, remote token estimates)
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=MAX_WORKERS))
+    
+    # Ctrl+C cancels this task so the interrupt handler below can save the
+    # context. asyncio.run() only does this itself on Python 3.11+; before
+    # that the KeyboardInterrupt is raised inside the event loop instead.
+    try:
+        loop.add_signal_handler(signal.SIGINT, asyncio.current_task().cancel)
+    except NotImplementedError:
+        pass  # Not supported on Windows, Ctrl+C raises KeyboardInterrupt there
     
     # Initialize message history
     messages = [
         {"role": "system", "content": get_system_prompt()}
     ]
     
-    if is_recovery:
+    # Raw reasoning per iteration, kept locally for logs and backups
+    reasoning_log: List[tuple[int, str]] = []
+    
+    # Digests of recent tool results, and the original text of any result
+    # that was shortened before entering the history
+    recent_results = deque(maxlen=RECENT_RESULTS_WINDOW)
+    tool_results_full: Dict[str, str] = {}
+    
+    if is_recovery and isinstance(user_prompt, dict):
+        # Full snapshot: restore the history as-is, with the current system prompt
+        messages.extend(m for m in user_prompt["messages"] if m.get("role") != "system")
+        messages.append({
+            "role": "user",
+            "content": "Please continue the work from where we left off."
+        })
+        reasoning_log.extend(tuple(entry) for entry in user_prompt.get("reasoning_log", []))
+        tool_results_full.update(user_prompt.get("tool_results_full", {}))
+        if user_prompt.get("project_folder"):
+            set_active_project_folder(user_prompt["project_folder"])
+        print("🔄 Recovery mode: Continuing from snapshot\n")
+    elif is_recovery:
         messages.append({
             "role": "user",
             "content": f"[RECOVERED CONTEXT]\n\n{user_prompt}\n\n[END RECOVERED CONTEXT]\n\nPlease continue the work from where we left off."
@@ -230,6 +429,9 @@ def main():
         })
         print(f"\n📝 Task: {user_prompt}\n")
     
+    if not keep_reasoning:
+        messages = strip_stale_reasoning(messages)
+    
     # Get tool definitions and mapping
     tools = get_tool_definitions()
     tool_map = get_tool_map()
@@ -243,52 +445,57 @@ def main():
     print(f"Auto-compression at: {COMPRESSION_THRESHOLD:,} tokens")
     print("=" * 60 + "\n")
     
+    # Running token count, updated as messages are appended
+    token_count = count_tokens(messages, MODEL_NAME)
+    
     # Main agent loop
     for iteration in range(1, MAX_ITERATIONS + 1):
         print(f"\n{'─' * 60}")
         print(f"Iteration {iteration}/{MAX_ITERATIONS}")
         print(f"{'─' * 60}")
         
-        # Check token count before making API call
-        try:
-            token_count = estimate_token_count(base_url, api_key, MODEL_NAME, messages)
-            print(f"📊 Current tokens: {token_count:,}/{TOKEN_LIMIT:,} ({token_count/TOKEN_LIMIT*100:.1f}%)")
-            
-            # Trigger compression if approaching limit
-            if token_count >= COMPRESSION_THRESHOLD:
-                print(f"\n⚠️  Approaching token limit! Compressing context...")
-                compression_result = compress_context_impl(
-                    messages=messages,
-                    client=client,
-                    model=MODEL_NAME,
-                    keep_recent=10
+        # Correct drift in the running count against the API now and then
+        if remote_tokens and (
+            iteration % DRIFT_CHECK_INTERVAL == 0
+            or token_count >= COMPRESSION_THRESHOLD * ESTIMATE_MARGIN
+        ):
+            try:
+                token_count = await asyncio.to_thread(
+                    cached_estimate_token_count, base_url, api_key, MODEL_NAME, messages
                 )
-                
-                if "compressed_messages" in compression_result:
-                    messages = compression_result["compressed_messages"]
-                    print(f"✓ {compression_result['message']}")
-                    print(f"✓ Estimated tokens saved: ~{compression_result.get('tokens_saved', 0):,}")
-                    
-                    # Recalculate token count
-                    token_count = estimate_token_count(base_url, api_key, MODEL_NAME, messages)
-                    print(f"📊 New token count: {token_count:,}/{TOKEN_LIMIT:,}\n")
+            except Exception as e:
+                print(f"⚠️  Warning: Could not estimate token count: {e}")
         
-        except Exception as e:
-            print(f"⚠️  Warning: Could not estimate token count: {e}")
-            token_count = 0
+        print(f"📊 Current tokens: {token_count:,}/{TOKEN_LIMIT:,} ({token_count/TOKEN_LIMIT*100:.1f}%)")
         
-        # Auto-backup every N iterations
+        # Trigger compression if approaching limit
+        if token_count >= COMPRESSION_THRESHOLD:
+            print(f"\n⚠️  Approaching token limit! Compressing context...")
+            compression_result = await compress_context_async(
+                messages=messages,
+                client=client,
+                model=MODEL_NAME,
+                keep_recent=10
+            )
+            
+            if "compressed_messages" in compression_result:
+                messages = compression_result["compressed_messages"]
+                if not keep_reasoning:
+                    messages = strip_stale_reasoning(messages)
+                recent_results.clear()  # Earlier results may be summarized away
+                print(f"✓ {compression_result['message']}")
+                print(f"✓ Estimated tokens saved: ~{compression_result.get('tokens_saved', 0):,}")
+                
+                # Recalculate token count
+                token_count = count_tokens(messages, MODEL_NAME)
+                print(f"📊 New token count: {token_count:,}/{TOKEN_LIMIT:,}\n")
+        
+        # Auto-backup every N iterations (a local snapshot, no API call)
         if iteration % BACKUP_INTERVAL == 0:
             print(f"💾 Auto-backup (iteration {iteration})...")
             try:
-                compression_result = compress_context_impl(
-                    messages=messages,
-                    client=client,
-                    model=MODEL_NAME,
-                    keep_recent=len(messages)  # Keep all messages, just save summary
-                )
-                if compression_result.get("summary_file"):
-                    print(f"✓ Backup saved: {os.path.basename(compression_result['summary_file'])}\n")
+                snapshot_file = snapshot_messages(messages, reasoning_log, tool_results_full)
+                print(f"✓ Backup saved: {os.path.basename(snapshot_file)}\n")
             except Exception as e:
                 print(f"⚠️  Warning: Backup failed: {e}\n")
         
@@ -296,20 +503,22 @@ def main():
         try:
             print("🤖 Calling kimi-k2-thinking model...\n")
             
-            stream = client.chat.completions.create(
+            stream = await client.chat.completions.create(
                 model=MODEL_NAME,
                 messages=messages,
                 max_tokens=65536,  # 64K tokens
-                tools=tools,
                 temperature=1.0,
                 stream=True,  # Enable streaming
+                # The tool schema never changes, so send it as-is instead of
+                # letting the SDK re-walk and transform it on every call
+                extra_body={"tools": tools},
             )
             
-            # Accumulate the streaming response
-            reasoning_content = ""
-            content_text = ""
+            # Accumulate the streaming response straight into the API message
+            msg_dict = {"role": "assistant"}
+            reasoning_parts = []
+            content_parts = []
             tool_calls_data = []
-            role = None
             finish_reason = None
             
             # Track if we've printed headers
@@ -318,31 +527,59 @@ def main():
             tool_call_header_printed = False
             last_tool_index = -1
             
+            # Streamed text is written unflushed and flushed on a timer,
+            # instead of one flush per chunk. Functions used per chunk are
+            # bound to locals to skip global/attribute lookups in the loop.
+            out = sys.stdout.write
+            flush = sys.stdout.flush
+            monotonic = time.monotonic
+            estimate = fast_estimate_raw
+            last_flush = monotonic()
+            last_progress = 0.0
+            
+            # Text written right after a flush is flushed by a timer, so it
+            # still shows up if the stream pauses before the next chunk
+            flush_timer = None
+            
+            def trailing_flush():
+                nonlocal flush_timer, last_flush
+                flush_timer = None
+                flush()
+                last_flush = monotonic()
+            
             # Process the stream
-            for chunk in stream:
+            async for chunk in stream:
                 if not chunk.choices:
                     continue
-                    
+                
+                now = monotonic()
                 delta = chunk.choices[0].delta
                 finish_reason = chunk.choices[0].finish_reason
                 
+                # Standard fields always exist on the delta (None when absent);
+                # reasoning_content is a Moonshot extra, so it needs a default
+                role = delta.role
+                reasoning = getattr(delta, "reasoning_content", None)
+                content = delta.content
+                tool_call_deltas = delta.tool_calls
+                
                 # Get role if present (first chunk)
-                if hasattr(delta, "role") and delta.role:
-                    role = delta.role
+                if role:
+                    msg_dict["role"] = role
                 
                 # Handle reasoning_content streaming
-                if hasattr(delta, "reasoning_content") and delta.reasoning_content:
+                if reasoning:
                     if not reasoning_header_printed:
                         print("=" * 60)
                         print(f"🧠 Reasoning (Iteration {iteration})")
                         print("=" * 60)
                         reasoning_header_printed = True
                     
-                    print(delta.reasoning_content, end="", flush=True)
-                    reasoning_content += delta.reasoning_content
+                    out(reasoning)
+                    reasoning_parts.append(reasoning)
                 
                 # Handle regular content streaming
-                if hasattr(delta, "content") and delta.content:
+                if content:
                     # Close reasoning section if it was open
                     if reasoning_header_printed and not content_header_printed:
                         print("\n" + "=" * 60 + "\n")
@@ -352,48 +589,67 @@ def main():
                         print("-" * 60)
                         content_header_printed = True
                     
-                    print(delta.content, end="", flush=True)
-                    content_text += delta.content
+                    out(content)
+                    content_parts.append(content)
+                
+                # Flush after writing, or leave it to the timer if the last
+                # flush was too recent
+                if reasoning or content:
+                    if now - last_flush > STDOUT_FLUSH_INTERVAL:
+                        flush()
+                        last_flush = now
+                    elif flush_timer is None:
+                        flush_timer = loop.call_later(STDOUT_FLUSH_INTERVAL, trailing_flush)
                 
                 # Handle tool_calls
-                if hasattr(delta, "tool_calls") and delta.tool_calls:
-                    for tc_delta in delta.tool_calls:
+                if tool_call_deltas:
+                    for tc_delta in tool_call_deltas:
                         # Ensure we have enough slots in tool_calls_data
-                        while len(tool_calls_data) <= tc_delta.index:
-                            tool_calls_data.append({
-                                "id": None,
-                                "type": "function",
-                                "function": {"name": "", "arguments": ""},
-                                "chars_received": 0
-                            })
+                        needed = tc_delta.index + 1 - len(tool_calls_data)
+                        if needed > 0:
+                            tool_calls_data.extend(ToolCallSlot() for _ in range(needed))
                         
                         tc = tool_calls_data[tc_delta.index]
+                        fn = tc_delta.function
+                        fn_name = fn.name if fn else None
+                        fn_arguments = fn.arguments if fn else None
                         
                         # Print header when we start receiving a tool call
                         if tc_delta.index != last_tool_index:
+                            # Finish the previous call's progress line with its final count
+                            if fn_name and last_tool_index >= 0 and tool_calls_data[last_tool_index].chars_received:
+                                out(tool_calls_data[last_tool_index].progress_line())
+                            
                             if reasoning_header_printed or content_header_printed:
                                 print("\n" + "=" * 60 + "\n")
                             
-                            if hasattr(tc_delta, "function") and tc_delta.function.name:
-                                print(f"🔧 Preparing tool call: {tc_delta.function.name}")
+                            if fn_name:
+                                print(f"🔧 Preparing tool call: {fn_name}")
                                 print("─" * 60)
                                 tool_call_header_printed = True
                                 last_tool_index = tc_delta.index
+                                last_progress = 0.0  # Show the new call's progress right away
                         
                         if tc_delta.id:
-                            tc["id"] = tc_delta.id
-                        if hasattr(tc_delta, "function"):
-                            if tc_delta.function.name:
-                                tc["function"]["name"] = tc_delta.function.name
-                            if tc_delta.function.arguments:
-                                tc["function"]["arguments"] += tc_delta.function.arguments
-                                tc["chars_received"] += len(tc_delta.function.arguments)
-                                
-                                # Show progress indicator every 500 characters
-                                if tc["chars_received"] % 500 == 0 or tc["chars_received"] < 100:
-                                    # Calculate approximate words (rough estimate: 5 chars per word)
-                                    words = tc["chars_received"] // 5
-                                    print(f"\r💬 Generating arguments... {tc['chars_received']:,} characters (~{words:,} words)", end="", flush=True)
+                            tc.id = tc_delta.id
+                        if fn_name:
+                            tc.name = fn_name
+                        if fn_arguments:
+                            tc.arguments_parts.append(fn_arguments)
+                            tc.chars_received += len(fn_arguments)
+                            tc.tokens_estimate += estimate(fn_arguments)
+                            
+                            # Show progress indicator, at most every PROGRESS_INTERVAL
+                            if now - last_progress >= PROGRESS_INTERVAL:
+                                out(tc.progress_line())
+                                flush()
+                                last_progress = last_flush = now
+            
+            if flush_timer is not None:
+                flush_timer.cancel()
+            if last_tool_index >= 0 and tool_calls_data[last_tool_index].chars_received:
+                out(tool_calls_data[last_tool_index].progress_line())
+            flush()
             
             # Print closing for content if it was printed
             if content_header_printed:
@@ -404,40 +660,36 @@ def main():
                 print("\n✓ Tool call complete")
                 print("─" * 60 + "\n")
             
-            # Reconstruct the message object from accumulated data
-            class ReconstructedMessage:
-                def __init__(self):
-                    self.role = role or "assistant"
-                    self.content = content_text if content_text else None
-                    self.reasoning_content = reasoning_content if reasoning_content else None
-                    self.tool_calls = None
-                    
-                    if tool_calls_data:
-                        # Convert to proper format
-                        from openai.types.chat import ChatCompletionMessageToolCall
-                        from openai.types.chat.chat_completion_message_tool_call import Function
-                        
-                        self.tool_calls = []
-                        for tc in tool_calls_data:
-                            if tc["id"]:  # Only add if we have an ID
-                                tool_call = type('ToolCall', (), {
-                                    'id': tc["id"],
-                                    'type': 'function',
-                                    'function': type('Function', (), {
-                                        'name': tc["function"]["name"],
-                                        'arguments': tc["function"]["arguments"]
-                                    })()
-                                })()
-                                self.tool_calls.append(tool_call)
-            
-            message = ReconstructedMessage()
-            
-            # Convert message to dict and add to history
-            # Important: preserve the full message object structure
-            messages.append(convert_message_for_api(message))
+            # Finish the assistant message and add it to history
+            if content_parts:
+                msg_dict["content"] = "".join(content_parts)
+            if reasoning_parts:
+                reasoning_content = "".join(reasoning_parts)
+                reasoning_log.append((iteration, reasoning_content))
+                # Kept for the rest of the tool chain, the model reasons across calls
+                msg_dict["reasoning_content"] = reasoning_content
+            tool_calls = []
+            parsed_args = []
+            for tc in tool_calls_data:
+                if not tc.id:  # Only add if we have an ID
+                    continue
+                arguments = "".join(tc.arguments_parts)
+                tool_calls.append({
+                    "id": tc.id,
+                    "type": "function",
+                    "function": {
+                        "name": tc.name,
+                        "arguments": arguments
+                    }
+                })
+                parsed_args.append(parse_tool_arguments(arguments))
+            if tool_calls:
+                msg_dict["tool_calls"] = tool_calls
+            messages.append(msg_dict)
+            token_count += count_message_tokens(msg_dict, MODEL_NAME)
             
             # Check if the model called any tools
-            if not message.tool_calls:
+            if not tool_calls:
                 print("=" * 60)
                 print("✅ TASK COMPLETED")
                 print("=" * 60)
@@ -446,87 +698,93 @@ def main():
                 break
             
             # Handle tool calls
-            print(f"\n🔧 Model decided to call {len(message.tool_calls)} tool(s):")
-
-            for tool_call in message.tool_calls:
-                func_name = tool_call.function.name
-                args_str = tool_call.function.arguments
-                result = None
+            print(f"\n🔧 Model decided to call {len(tool_calls)} tool(s):")
 
-                try:
-                    try:
-                        args = json.loads(args_str)
-                    except json.JSONDecodeError:
-                        args = {}
-
-                    print(f"\n  → {func_name}")
-                    print(f"    Arguments: {json.dumps(args, ensure_ascii=False, indent=6)}")
-
-                    # Get the tool implementation
-                    tool_func = tool_map.get(func_name)
-
-                    if not tool_func:
-                        result = f"Error: Unknown tool '{func_name}'"
-                        print(f"    ✗ {result}")
-                    else:
+            # Independent calls run concurrently; results are still added to
+            # messages in the original order so ids pair up with their calls
+            answered = set()
+            try:
+                for batch in batch_tool_calls(tool_calls, parsed_args):
+                    first_name = tool_calls[batch[0]]["function"]["name"]
+                    
+                    if first_name == "compress_context":
                         # Special handling for compress_context (needs extra params)
-                        if func_name == "compress_context":
-                            result_data = compress_context_impl(
+                        try:
+                            result_data = await compress_context_async(
                                 messages=messages,
                                 client=client,
                                 model=MODEL_NAME,
                                 keep_recent=10
                             )
-                            result = result_data.get("message", "Compression completed")
-
+                            outcomes = [(result_data.get("message", "Compression completed"), True)]
+                            
                             # Update messages with compressed version
                             if "compressed_messages" in result_data:
                                 messages = result_data["compressed_messages"]
+                                if not keep_reasoning:
+                                    messages = strip_stale_reasoning(messages)
+                                recent_results.clear()
+                                token_count = count_tokens(messages, MODEL_NAME)
+                        except Exception as tool_error:
+                            outcomes = [(f"Error executing tool '{first_name}': {str(tool_error)}", False)]
+                    else:
+                        outcomes = await asyncio.gather(*(
+                            asyncio.to_thread(run_tool, tool_map, tool_calls[i]["function"]["name"], parsed_args[i])
+                            for i in batch
+                        ))
+                    
+                    for i, (result, ok) in zip(batch, outcomes):
+                        tool_call = tool_calls[i]
+                        func_name = tool_call["function"]["name"]
+                        
+                        print(f"\n  → {func_name}")
+                        if debug:
+                            print(f"    Arguments: {json.dumps(parsed_args[i], ensure_ascii=False, indent=6)}")
                         else:
-                            # Call the tool with its arguments
-                            result = tool_func(**args)
-
-                        # Print result (truncate if too long)
-                        if len(str(result)) > 200:
-                            print(f"    ✓ {str(result)[:200]}...")
+                            print(f"    Arguments: {short_json(parsed_args[i])}")
+                        
+                        if ok:
+                            # Print result (truncate if too long)
+                            print(f"    ✓ {result[:200]}{'...' if len(result) > 200 else ''}")
                         else:
-                            print(f"    ✓ {result}")
-
-                except Exception as tool_error:
-                    # Catch any exception during tool execution
-                    result = f"Error executing tool '{func_name}': {str(tool_error)}"
-                    print(f"    ✗ {result}")
-
-                finally:
-                    # ALWAYS add tool result to messages, even if there was an error
-                    # This ensures every tool_call_id gets a response
-                    if result is None:
-                        result = f"Error: Tool '{func_name}' returned no result"
-
+                            print(f"    ✗ {result}")
+                        
+                        # Fold repeated or verbose output before it enters the history
+                        content = postprocess_tool_result(func_name, parsed_args[i], result, recent_results, ok)
+                        if content != result:
+                            tool_results_full[tool_call["id"]] = result
+                        
+                        # Every tool_call_id gets a response, even on errors
+                        tool_message = {
+                            "role": "tool",
+                            "tool_call_id": tool_call["id"],
+                            "name": func_name,
+                            "content": content
+                        }
+                        messages.append(tool_message)
+                        answered.add(tool_call["id"])
+                        token_count += count_message_tokens(tool_message, MODEL_NAME)
+            finally:
+                # Every tool_call_id gets a response, even if a batch failed
+                # or was interrupted before its results were added
+                for tool_call in tool_calls:
+                    if tool_call["id"] in answered:
+                        continue
                     tool_message = {
                         "role": "tool",
-                        "tool_call_id": tool_call.id,
-                        "name": func_name,
-                        "content": str(result)
+                        "tool_call_id": tool_call["id"],
+                        "name": tool_call["function"]["name"],
+                        "content": f"Error: No result was recorded for tool '{tool_call['function']['name']}'"
                     }
                     messages.append(tool_message)
+                    token_count += count_message_tokens(tool_message, MODEL_NAME)
         
-        except KeyboardInterrupt:
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            # Ctrl+C arrives as a cancellation of this task (see the SIGINT
+            # handler above), or as KeyboardInterrupt where that is unsupported
             print("\n\n⚠️  Interrupted by user. Saving context...")
             # Save current context before exiting
-            try:
-                compression_result = compress_context_impl(
-                    messages=messages,
-                    client=client,
-                    model=MODEL_NAME,
-                    keep_recent=len(messages)
-                )
-                if compression_result.get("summary_file"):
-                    print(f"✓ Context saved to: {compression_result['summary_file']}")
-                    print(f"\nTo resume, run:")
-                    print(f"  python kimi-writer.py --recover {compression_result['summary_file']}")
-            except:
-                pass
+            await save_context_on_exit(messages, client, reasoning_log, tool_results_full)
             sys.exit(0)
         
         except Exception as e:
@@ -542,21 +800,12 @@ def main():
         print(f"\nReached maximum of {MAX_ITERATIONS} iterations.")
         print("Saving final context...")
         
-        try:
-            compression_result = compress_context_impl(
-                messages=messages,
-                client=client,
-                model=MODEL_NAME,
-                keep_recent=len(messages)
-            )
-            if compression_result.get("summary_file"):
-                print(f"✓ Context saved to: {compression_result['summary_file']}")
-                print(f"\nTo resume, run:")
-                print(f"  python kimi-writer.py --recover {compression_result['summary_file']}")
-        except Exception as e:
-            print(f"✗ Error saving context: {e}")
+        await save_context_on_exit(messages, client, reasoning_log, tool_results_full)
 
 
 if __name__ == "__main__":
-    main()
+    # Read the prompt before the event loop starts, so Ctrl+C at the prompt
+    # is a plain KeyboardInterrupt rather than a pending task cancellation
+    user_prompt, is_recovery = get_user_input()
+    asyncio.run(main(user_prompt, is_recovery))
 
@@ -5,11 +5,19 @@ Exports all available tools for the agent to use.
 
 from .writer import write_file_impl
 from .project import create_project_impl
-from .compression import compress_context_impl
+from .compression import (
+    compress_context_impl,
+    compress_context_async,
+    snapshot_messages,
+    load_snapshot,
+)
 
 __all__ = [
     'write_file_impl',
     'create_project_impl', 
     'compress_context_impl',
+    'compress_context_async',
+    'snapshot_messages',
+    'load_snapshot',
 ]
 
@@ -4,56 +4,36 @@ Context compression tool for managing conversation history.
 
 import os
 import json
+import zstandard
 from datetime import datetime
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 from .project import get_active_project_folder
+from utils import fast_estimate
 
 
-def compress_context_impl(
-    messages: List[Any],
-    client,
-    model: str,
-    keep_recent: int = 10
-) -> Dict[str, Any]:
+def _prepare_compression(messages: List[Any], keep_recent: int) -> Dict[str, Any]:
     """
-    Compresses the conversation context by summarizing older messages.
-    
-    This function:
-    1. Takes all messages except the most recent ones
-    2. Calls the kimi API to create a comprehensive summary
-    3. Saves the summary to a timestamped file
-    4. Returns the compressed messages list and stats
+    Splits the history and builds the summarization request.
     
     Args:
         messages: The full message history
-        client: The OpenAI client instance
-        model: The model to use for summarization
         keep_recent: Number of recent messages to keep uncompressed
         
     Returns:
-        Dictionary containing:
-        - compressed_messages: New message list with compression applied
-        - summary_file: Path to saved summary file
-        - tokens_before: Estimated tokens before compression
-        - tokens_after: Estimated tokens after compression
+        Dictionary with the system message, the messages to compress, the
+        recent messages to keep, and the request messages for the summary call
     """
-    if len(messages) <= keep_recent + 1:  # +1 for system message
-        return {
-            "compressed_messages": messages,
-            "summary_file": None,
-            "tokens_saved": 0,
-            "message": "Not enough messages to compress."
-        }
-    
     # Separate system message, messages to compress, and recent messages
     system_message = messages[0] if messages and messages[0].get("role") == "system" else None
     
+    # Index-based split so keep_recent=0 summarizes everything
+    split = len(messages) - keep_recent
     if system_message:
-        messages_to_compress = messages[1:-keep_recent]
-        recent_messages = messages[-keep_recent:]
+        messages_to_compress = messages[1:split]
+        recent_messages = messages[split:]
     else:
-        messages_to_compress = messages[:-keep_recent]
-        recent_messages = messages[-keep_recent:]
+        messages_to_compress = messages[:split]
+        recent_messages = messages[split:]
     
     # Create a detailed prompt for summarization
     summary_prompt = """Please provide a comprehensive summary of the conversation history below. Include:
@@ -99,27 +79,52 @@ Conversation history to summarize:
         elif role == "user":
             conversation_text += f"\n[User]: {content}\n"
     
-    # Call the API to get summary
-    try:
-        summary_response = client.chat.completions.create(
-            model=model,
-            messages=[
-                {"role": "system", "content": "You are a helpful assistant that creates comprehensive summaries of conversations."},
-                {"role": "user", "content": summary_prompt + conversation_text}
-            ],
-            temperature=0.7,
-            max_tokens=4096
-        )
-        
-        summary = summary_response.choices[0].message.content
+    return {
+        "system_message": system_message,
+        "messages_to_compress": messages_to_compress,
+        "recent_messages": recent_messages,
+        "request_messages": [
+            {"role": "system", "content": "You are a helpful assistant that creates comprehensive summaries of conversations."},
+            {"role": "user", "content": summary_prompt + conversation_text}
+        ]
+    }
+
+
+def _not_enough_messages(messages: List[Any]) -> Dict[str, Any]:
+    """Result returned when there is nothing worth compressing."""
+    return {
+        "compressed_messages": messages,
+        "summary_file": None,
+        "tokens_saved": 0,
+        "message": "Not enough messages to compress."
+    }
+
+
+def _compression_error(messages: List[Any], e: Exception) -> Dict[str, Any]:
+    """Result returned when the summarization call fails."""
+    return {
+        "compressed_messages": messages,
+        "summary_file": None,
+        "tokens_saved": 0,
+        "message": f"Error during compression: {str(e)}"
+    }
+
+
+def _finish_compression(prepared: Dict[str, Any], summary: str, keep_recent: int) -> Dict[str, Any]:
+    """
+    Saves the summary and builds the compressed message list.
+    
+    Args:
+        prepared: Output of _prepare_compression
+        summary: The summary text returned by the model
+        keep_recent: Number of recent messages kept uncompressed
         
-    except Exception as e:
-        return {
-            "compressed_messages": messages,
-            "summary_file": None,
-            "tokens_saved": 0,
-            "message": f"Error during compression: {str(e)}"
-        }
+    Returns:
+        The compression result dictionary
+    """
+    system_message = prepared["system_message"]
+    messages_to_compress = prepared["messages_to_compress"]
+    recent_messages = prepared["recent_messages"]
     
     # Save summary to file
     project_folder = get_active_project_folder()
@@ -159,9 +164,8 @@ Conversation history to summarize:
     compressed_messages.extend(recent_messages)
     
     # Calculate token savings (rough estimate)
-    original_length = sum(len(str(m)) for m in messages_to_compress)
-    compressed_length = len(summary)
-    estimated_tokens_saved = (original_length - compressed_length) // 4  # Rough estimate
+    original_tokens = sum(fast_estimate(str(m)) for m in messages_to_compress)
+    estimated_tokens_saved = original_tokens - fast_estimate(summary)
     
     return {
         "compressed_messages": compressed_messages,
@@ -172,3 +176,198 @@ Conversation history to summarize:
         "message": f"Successfully compressed {len(messages_to_compress)} messages. Summary saved to {os.path.basename(summary_file)}."
     }
 
+
+def compress_context_impl(
+    messages: List[Any],
+    client,
+    model: str,
+    keep_recent: int = 10
+) -> Dict[str, Any]:
+    """
+    Compresses the conversation context by summarizing older messages.
+    
+    This function:
+    1. Takes all messages except the most recent ones
+    2. Calls the kimi API to create a comprehensive summary
+    3. Saves the summary to a timestamped file
+    4. Returns the compressed messages list and stats
+    
+    Args:
+        messages: The full message history
+        client: The OpenAI client instance
+        model: The model to use for summarization
+        keep_recent: Number of recent messages to keep uncompressed
+        
+    Returns:
+        Dictionary containing:
+        - compressed_messages: New message list with compression applied
+        - summary_file: Path to saved summary file
+        - tokens_before: Estimated tokens before compression
+        - tokens_after: Estimated tokens after compression
+    """
+    if len(messages) <= keep_recent + 1:  # +1 for system message
+        return _not_enough_messages(messages)
+    
+    prepared = _prepare_compression(messages, keep_recent)
+    
+    # Call the API to get summary
+    try:
+        summary_response = client.chat.completions.create(
+            model=model,
+            messages=prepared["request_messages"],
+            temperature=0.7,
+            max_tokens=4096
+        )
+        
+        summary = summary_response.choices[0].message.content
+        
+    except Exception as e:
+        return _compression_error(messages, e)
+    
+    return _finish_compression(prepared, summary, keep_recent)
+
+
+async def compress_context_async(
+    messages: List[Any],
+    client,
+    model: str,
+    keep_recent: int = 10
+) -> Dict[str, Any]:
+    """
+    Same as compress_context_impl, but for an AsyncOpenAI client.
+    
+    Args:
+        messages: The full message history
+        client: The AsyncOpenAI client instance
+        model: The model to use for summarization
+        keep_recent: Number of recent messages to keep uncompressed
+        
+    Returns:
+        The compression result dictionary (see compress_context_impl)
+    """
+    if len(messages) <= keep_recent + 1:  # +1 for system message
+        return _not_enough_messages(messages)
+    
+    prepared = _prepare_compression(messages, keep_recent)
+    
+    # Call the API to get summary
+    try:
+        summary_response = await client.chat.completions.create(
+            model=model,
+            messages=prepared["request_messages"],
+            temperature=0.7,
+            max_tokens=4096
+        )
+        
+        summary = summary_response.choices[0].message.content
+        
+    except Exception as e:
+        return _compression_error(messages, e)
+    
+    return _finish_compression(prepared, summary, keep_recent)
+
+
+def _answer_pending_tool_calls(messages: List[Any]) -> List[Any]:
+    """
+    Adds an error response for every tool call that has none.
+    
+    A history saved mid-turn (e.g. on Ctrl+C while tools run) can end with an
+    assistant message whose tool calls were not all answered, which the API
+    rejects when the history is replayed.
+    
+    Args:
+        messages: The message history
+        
+    Returns:
+        A copy of the history where every tool call has a response
+    """
+    answered = []
+    pending = []
+    
+    def close_turn():
+        for call_id, name in pending:
+            answered.append({
+                "role": "tool",
+                "tool_call_id": call_id,
+                "name": name,
+                "content": f"Error: Tool '{name}' was interrupted before it returned a result"
+            })
+        pending.clear()
+    
+    for msg in messages:
+        role = msg.get("role") if isinstance(msg, dict) else None
+        if role == "tool":
+            pending[:] = [(call_id, name) for call_id, name in pending if call_id != msg.get("tool_call_id")]
+        else:
+            close_turn()
+            if role == "assistant":
+                pending.extend(
+                    (tc["id"], tc["function"]["name"]) for tc in msg.get("tool_calls") or []
+                )
+        answered.append(msg)
+    close_turn()
+    return answered
+
+
+def snapshot_messages(
+    messages: List[Any],
+    reasoning_log: Optional[List[tuple]] = None,
+    tool_results_full: Optional[Dict[str, str]] = None,
+    path: Optional[str] = None
+) -> str:
+    """
+    Saves the full message history to a zstd-compressed JSON snapshot.
+    
+    Unlike compress_context_impl this makes no API call, so it is cheap
+    enough for periodic backups. Snapshots can be passed to --recover.
+    Unanswered tool calls are given an error response in the saved copy.
+    
+    Args:
+        messages: The full message history
+        reasoning_log: Optional (iteration, reasoning) pairs to keep alongside
+        tool_results_full: Optional original text of tool results that were
+            shortened in the history, keyed by tool call id
+        path: Where to write the snapshot (defaults to a timestamped file
+            in the active project folder)
+        
+    Returns:
+        Path to the saved snapshot file
+    """
+    if path is None:
+        project_folder = get_active_project_folder()
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        filename = f".context_snapshot_{timestamp}.json.zst"
+        # If no project folder, save in current directory
+        path = os.path.join(project_folder, filename) if project_folder else filename
+    
+    snapshot = {
+        "project_folder": get_active_project_folder(),
+        "messages": _answer_pending_tool_calls(messages),
+        "reasoning_log": reasoning_log or [],
+        "tool_results_full": tool_results_full or {},
+    }
+    data = json.dumps(snapshot, ensure_ascii=False, default=str).encode('utf-8')
+    with open(path, 'wb') as f:
+        f.write(zstandard.ZstdCompressor(level=3).compress(data))
+    return path
+
+
+def load_snapshot(path: str) -> Dict[str, Any]:
+    """
+    Loads a snapshot written by snapshot_messages.
+    
+    Tool calls left unanswered in the saved history get an error response,
+    so the history can be sent to the API as-is.
+    
+    Args:
+        path: Path to the .json.zst snapshot file
+        
+    Returns:
+        Dictionary with project_folder, messages, reasoning_log and
+        tool_results_full
+    """
+    with open(path, 'rb') as f:
+        data = zstandard.ZstdDecompressor().decompress(f.read())
+    snapshot = json.loads(data.decode('utf-8'))
+    snapshot["messages"] = _answer_pending_tool_calls(snapshot.get("messages", []))
+    return snapshot
@@ -2,11 +2,61 @@
 Utility functions for the Kimi Writing Agent.
 """
 
+import re
 import json
+import hashlib
 import httpx
+from collections import deque
+from functools import lru_cache
 from typing import List, Dict, Any, Callable
 
 
+# Cache of remote token estimates keyed by message-list fingerprint
+_token_cache: Dict[tuple, int] = {}
+
+# Character classes and their approximate tokens-per-character ratios
+_TOKEN_CLASS_PATTERN = re.compile(
+    r'(?P<cjk>[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af])'
+    r'|(?P<alpha>[a-zA-Z]+)'
+    r'|(?P<digit>\d+)'
+    r'|(?P<other>[^\s])'
+)
+_TOKEN_RATIOS = {'cjk': 0.55, 'alpha': 0.25, 'digit': 0.4, 'other': 0.5}
+
+# Tool output folding: results longer than this are cleaned up, keeping at
+# most this many lines; separator lines are runs of = - _ * or box drawing
+FOLD_MIN_CHARS = 2000
+FOLD_MAX_LINES = 200
+_SEPARATOR_LINE_PATTERN = re.compile(r'^\s*([=\-_*─━]{3,})\s*$')
+
+# Connection pool settings shared by the chat and token-estimate clients
+HTTP_LIMITS = httpx.Limits(max_keepalive_connections=4, keepalive_expiry=120)
+HTTP_TIMEOUT = httpx.Timeout(600.0, connect=10.0)
+
+
+@lru_cache(maxsize=4)
+def get_token_client(base_url: str, api_key: str) -> httpx.Client:
+    """
+    Returns a pooled HTTP client for the token estimation endpoint.
+    
+    The client is kept alive between calls so repeated estimates reuse the
+    same connection instead of doing a fresh TLS handshake each time.
+    
+    Args:
+        base_url: The base URL for the API
+        api_key: The API key for authentication
+        
+    Returns:
+        Shared httpx.Client for this base URL and key
+    """
+    return httpx.Client(
+        base_url=base_url,
+        headers={"Authorization": f"Bearer {api_key}"},
+        limits=HTTP_LIMITS,
+        timeout=30.0
+    )
+
+
 def estimate_token_count(base_url: str, api_key: str, model: str, messages: List[Dict]) -> int:
     """
     Estimate the token count for the given messages using the Moonshot API.
@@ -52,27 +102,292 @@ def estimate_token_count(base_url: str, api_key: str, model: str, messages: List
     token_base_url = base_url
     
     # Make the API call
-    with httpx.Client(
-        base_url=token_base_url,
-        headers={"Authorization": f"Bearer {api_key}"},
-        timeout=30.0
-    ) as client:
-        response = client.post(
-            "/tokenizers/estimate-token-count",
-            json={
-                "model": model,
-                "messages": serializable_messages
-            }
-        )
-        response.raise_for_status()
-        data = response.json()
-        return data.get("data", {}).get("total_tokens", 0)
+    client = get_token_client(token_base_url, api_key)
+    response = client.post(
+        "/tokenizers/estimate-token-count",
+        json={
+            "model": model,
+            "messages": serializable_messages
+        }
+    )
+    response.raise_for_status()
+    data = response.json()
+    return data.get("data", {}).get("total_tokens", 0)
+
+
+def messages_fingerprint(messages: List[Dict]) -> tuple:
+    """
+    Computes a cheap fingerprint of a message list.
+    
+    The history only ever grows at the end (or is replaced wholesale by
+    compression), so the length plus a digest of the last message is enough
+    to tell whether it changed since the last estimate.
+    
+    Args:
+        messages: List of message dictionaries
+        
+    Returns:
+        Hashable fingerprint tuple
+    """
+    if not messages:
+        return (0, b"")
+    last = json.dumps(messages[-1], default=str).encode()
+    return (len(messages), hashlib.blake2b(last, digest_size=8).digest())
+
+
+def cached_estimate_token_count(base_url: str, api_key: str, model: str, messages: List[Dict]) -> int:
+    """
+    Same as estimate_token_count, but skips the API call when the message
+    list has not changed since the last estimate.
+    
+    Args:
+        base_url: The base URL for the API
+        api_key: The API key for authentication
+        model: The model name
+        messages: List of message dictionaries
+        
+    Returns:
+        Total token count
+    """
+    fingerprint = messages_fingerprint(messages)
+    if fingerprint not in _token_cache:
+        _token_cache[fingerprint] = estimate_token_count(base_url, api_key, model, messages)
+    return _token_cache[fingerprint]
+
+
+def fast_estimate_raw(text: str) -> float:
+    """
+    Estimates the token count of text without rounding.
+    
+    Use this when summing estimates over many small fragments (e.g. streamed
+    chunks), and round only the total.
+    
+    Args:
+        text: The text to estimate
+        
+    Returns:
+        Approximate token count as a float
+    """
+    total = 0.0
+    for match in _TOKEN_CLASS_PATTERN.finditer(text):
+        total += len(match.group()) * _TOKEN_RATIOS[match.lastgroup]
+    return total
+
+
+def fast_estimate(text: str) -> int:
+    """
+    Quickly estimates the token count of text without a tokenizer.
+    
+    Weights each character class separately, so Chinese/Japanese/Korean
+    text (roughly one token per 1-2 characters) is not undercounted the
+    way a flat 4-characters-per-token rule would.
+    
+    Args:
+        text: The text to estimate
+        
+    Returns:
+        Approximate token count
+    """
+    return int(fast_estimate_raw(text) + 0.5)
+
+
+def fold_tool_output(text: str) -> str:
+    """
+    Strips low-signal lines from a long tool output.
+    
+    Drops blank lines, collapses runs of separator lines into one, and
+    truncates the output to FOLD_MAX_LINES lines.
+    
+    Args:
+        text: The raw tool output
+        
+    Returns:
+        The folded output
+    """
+    lines = []
+    previous_separator = False
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        is_separator = bool(_SEPARATOR_LINE_PATTERN.match(line))
+        if is_separator and previous_separator:
+            continue
+        previous_separator = is_separator
+        lines.append(line)
+    
+    if len(lines) > FOLD_MAX_LINES:
+        remaining = len(lines) - FOLD_MAX_LINES
+        lines = lines[:FOLD_MAX_LINES] + [f"... ({remaining} more lines)"]
+    return "\n".join(lines)
 
 
+def postprocess_tool_result(
+    func_name: str,
+    args: Dict[str, Any],
+    result: str,
+    recent_results: deque,
+    ok: bool = True
+) -> str:
+    """
+    Shrinks a tool result before it is added to the message history.
+    
+    A result identical to one of the recent results of the same tool is
+    replaced by a pointer to the earlier call, when the pointer is shorter,
+    and long results are folded. Errors are always kept as-is.
+    
+    Args:
+        func_name: Name of the tool that produced the result
+        args: Parsed arguments of the tool call
+        result: The tool result
+        recent_results: (digest, label) pairs of recent results; updated in place
+        ok: Whether the tool call succeeded
+        
+    Returns:
+        The result to store in the message history
+    """
+    if not ok or result.startswith("Error"):
+        return result
+    
+    digest = hashlib.blake2b(f"{func_name}\0{result}".encode(), digest_size=16).digest()
+    for seen_digest, seen_label in recent_results:
+        if seen_digest == digest:
+            pointer = f"[same as previous result for {seen_label}]"
+            if len(pointer) < len(result):
+                return pointer
+            break
+    else:
+        target = (args.get("filename") or args.get("project_name")) if isinstance(args, dict) else None
+        recent_results.append((digest, f"{func_name}:{target}" if target else func_name))
+    
+    if len(result) > FOLD_MIN_CHARS:
+        return fold_tool_output(result)
+    return result
+
+
+def strip_stale_reasoning(messages: List[Dict]) -> List[Dict]:
+    """
+    Drops reasoning_content from assistant turns before the last user message.
+    
+    kimi-k2-thinking reasons across tool calls, so the assistant messages of
+    the current tool chain (everything since the last user message) keep
+    their reasoning. Older turns are finished and only cost tokens.
+    
+    Args:
+        messages: List of message dictionaries
+        
+    Returns:
+        The message list, with copies of the messages that were stripped
+    """
+    last_user = max((i for i, m in enumerate(messages) if m.get("role") == "user"), default=-1)
+    return [
+        {k: v for k, v in m.items() if k != "reasoning_content"}
+        if i < last_user and m.get("role") == "assistant" and "reasoning_content" in m
+        else m
+        for i, m in enumerate(messages)
+    ]
+
+
+def short_json(obj: Any, n: int = 400) -> str:
+    """
+    Serializes an object to JSON for display, truncated to n characters.
+    
+    Args:
+        obj: The object to serialize
+        n: Maximum number of characters to show
+        
+    Returns:
+        The (possibly truncated) JSON string
+    """
+    s = json.dumps(obj, ensure_ascii=False)
+    return s if len(s) <= n else s[:n] + f"... ({len(s):,} chars total)"
+
+
+@lru_cache(maxsize=1)
+def get_encoder(model: str):
+    """
+    Returns a local tokenizer used to approximate the model's token count.
+    
+    Moonshot does not publish the kimi tokenizer, so cl100k_base is used as
+    a close stand-in. Falls back to None if tiktoken is not installed or the
+    encoding cannot be loaded (it is downloaded on first use).
+    
+    Args:
+        model: The model name
+        
+    Returns:
+        A tiktoken Encoding, or None if unavailable
+    """
+    try:
+        import tiktoken
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception:
+        return None
+
+
+@lru_cache(maxsize=8192)
+def count_text_tokens(text: str, model: str) -> int:
+    """
+    Counts the tokens in a piece of text with the local tokenizer.
+    
+    Results are cached, so messages already in the history are only
+    tokenized once no matter how many times the history is counted.
+    
+    Args:
+        text: The text to count
+        model: The model name
+        
+    Returns:
+        Token count
+    """
+    encoder = get_encoder(model)
+    if encoder is None:
+        return fast_estimate(text)
+    return len(encoder.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(msg: Dict, model: str) -> int:
+    """
+    Counts the tokens of a single message locally.
+    
+    Args:
+        msg: Message dictionary
+        model: The model name
+        
+    Returns:
+        Token count including a small per-message overhead
+    """
+    tokens = 4  # role and message delimiters
+    for key in ("content", "reasoning_content", "name"):
+        if msg.get(key):
+            tokens += count_text_tokens(msg[key], model)
+    for tc in msg.get("tool_calls") or []:
+        tokens += count_text_tokens(tc["function"]["name"] or "", model)
+        tokens += count_text_tokens(tc["function"]["arguments"] or "", model)
+    return tokens
+
+
+def count_tokens(messages: List[Dict], model: str) -> int:
+    """
+    Counts the tokens of a message list locally, without any API call.
+    
+    Args:
+        messages: List of message dictionaries
+        model: The model name
+        
+    Returns:
+        Total token count
+    """
+    return sum(count_message_tokens(msg, model) for msg in messages) + 3
+
+
+@lru_cache(maxsize=1)
 def get_tool_definitions() -> List[Dict[str, Any]]:
     """
     Returns the tool definitions in the format expected by kimi-k2-thinking.
     
+    The list is built once and the same object is returned on every call,
+    so treat it as read-only.
+    
     Returns:
         List of tool definition dictionaries
     """
@@ -135,6 +450,7 @@ def get_tool_definitions() -> List[Dict[str, Any]]:
     ]
 
 
+@lru_cache(maxsize=1)
 def get_tool_map() -> Dict[str, Callable]:
     """
     Returns a mapping of tool names to their implementation functions.
@@ -151,6 +467,7 @@ def get_tool_map() -> Dict[str, Callable]:
     }
 
 
+@lru_cache(maxsize=1)
 def get_system_prompt() -> str:
     """
     Returns the system prompt for the writing agent.